@@ -5,10 +5,11 @@
 # original TSQX by CJ Quines: https://github.com/cjquines/tsqx
 # original TSQ by evan chen
 
+import functools
 import re
 import sys
-from io import TextIOWrapper
-from typing import Any, Generator, TextIO, TypedDict
+from io import StringIO, TextIOWrapper
+from typing import Any, Generator, Sequence, TextIO, TypedDict
 
 
 def generate_points(kind, n) -> list[str]:
@@ -22,6 +23,9 @@ def generate_points(kind, n) -> list[str]:
 T_TOKEN = str | list[str] | list["T_TOKEN"]
 
 
+T_POINT_OPTS = tuple[bool, str | None, str]  # dot, label, direction
+
+
 class T_OCR(TypedDict):  # op, comment, raw
     op: "Op"
     comment: str
@@ -59,28 +63,47 @@ ARITHMETIC_OPERATORS = {"plus": "+", "minus": "-", "mult": "*", "divide": "/"}
 class Op:
     exp: T_TOKEN
 
-    def _join_exp(self, exp: T_TOKEN, join_str: str) -> str:
-        return join_str.join(self._emit_exp(e) for e in exp)
+    def _join_exp(self, exp: T_TOKEN, join_str: str, out: StringIO):
+        for i, e in enumerate(exp):
+            if i:
+                out.write(join_str)
+            self._write_exp(e, out)
 
-    def _emit_exp(self, exp: T_TOKEN) -> str:
+    def _write_exp(self, exp: T_TOKEN, out: StringIO):
         if not isinstance(exp, list):
-            return exp
+            out.write(exp)
+            return
         if "," in exp:
-            return f"({self._join_exp(exp, ' ')})"
+            out.write("(")
+            self._join_exp(exp, " ", out)
+            out.write(")")
+            return
         head, *tail = exp
         if not tail:
-            return self._emit_exp(head) if isinstance(head, list) else head
+            if isinstance(head, list):
+                self._write_exp(head, out)
+            else:
+                out.write(head)
         elif tail[0] in ["--", "..", "^^"]:
-            return self._join_exp(exp, ", ")
+            self._join_exp(exp, ", ", out)
         elif (binop := ARITHMETIC_OPERATORS.get(str(head))) is not None:
-            return "(" + self._join_exp(tail, binop) + ")"
+            out.write("(")
+            self._join_exp(tail, binop, out)
+            out.write(")")
         else:
-            return f"{head}({self._join_exp(tail, ', ')})"
+            out.write(f"{head}(")
+            self._join_exp(tail, ", ", out)
+            out.write(")")
 
     def emit_exp(self) -> str:
-        res = self._join_exp(self.exp, "*")
-        for j in ["--", "..", "^^"]:
-            res = res.replace(f", {j}, ", j)
+        res = self.__dict__.get("_emitted_exp")
+        if res is None:
+            buf = StringIO()
+            self._join_exp(self.exp, "*", buf)
+            res = buf.getvalue()
+            for j in ["--", "..", "^^"]:
+                res = res.replace(f", {j}, ", j)
+            self._emitted_exp = res
         return res
 
     def emit(self):
@@ -125,16 +148,19 @@ class Point(Op):
         self.direction = direction or f"dir({name})"
 
     def emit(self) -> str:
-        return f"pair {self.name} = {self.emit_exp()};"
+        res = self.__dict__.get("_emitted")
+        if res is None:
+            res = self._emitted = "pair " + self.name + " = " + self.emit_exp() + ";"
+        return res
 
     def post_emit(self):
         args = [self.name]
         if self.label:
-            args = [f'"${self.label}$"', *args, self.direction]
+            args = ['"$' + self.label + '$"', *args, self.direction]
         if self.dot:
-            return f"dot({', '.join(args)});"
+            return "dot(" + ", ".join(args) + ");"
         if len(args) > 1:
-            return f"label({', '.join(args)});"
+            return "label(" + ", ".join(args) + ");"
         return ""
 
 
@@ -153,84 +179,162 @@ class Draw(Op):
         exp = self.emit_exp()
         if self.fill:
             outline = self.outline or "defaultpen"
-            return f"filldraw({exp}, {self.fill}, {outline});"
+            return "filldraw(" + exp + ", " + self.fill + ", " + outline + ");"
         elif self.outline:
-            return f"draw({exp}, {self.outline});"
+            return "draw(" + exp + ", " + self.outline + ");"
         else:
-            return f"draw({exp});"
+            return "draw(" + exp + ");"
+
+
+_RADIUS_DIR_RE = re.compile(r"([\d\.]+)R([\d\.]+)")
+_DIR_PAIR_RE = re.compile(r"(\d+)([A-Z]+)")
+_COMPASS_RE = re.compile(r"N?S?E?W?")
+
+_TOKEN_REPLACEMENTS = [
+    # ~ and = are separate tokens
+    ("~", " ~ "),
+    ("=", " = "),
+    # for tsqx syntax processing
+    ("(", "( "),
+    (")", " ) "),
+    (",", " , "),
+    # spline joiners
+    ("--", " --  "),
+    ("..", " .. "),
+    ("^^", " ^^ "),
+    # no spaces around asymptote arithmetic
+    (" +", "+"),
+    ("+ ", "+"),
+    ("- ", "-"),
+    (" *", "*"),
+    ("* ", "*"),
+    # ' not allowed in variable names
+    ("'", "_prime"),
+    ("&", "_asterisk"),
+]
+# but slashes in draw ops should remain tokens
+_SLASH_REPLACEMENTS = [
+    (" / ", "  /  "),
+    (" /", "/"),
+    ("/ ", "/"),
+]
+
+
+def _is_opacity(pen: str) -> bool:
+    # same strings as re.fullmatch(r"\d*\.?\d*", pen)
+    return not (digits := pen.replace(".", "", 1)) or digits.isdecimal()
+
+
+ALIAS_MAP = {"": "dl", ":": "", ".": "d", ";": "l"}
+SOFT_ALIAS_MAP = ALIAS_MAP | {"": "l", ";": "dl"}
+ALIASES = frozenset(ALIAS_MAP.keys() | ALIAS_MAP.values())
+SOFT_ALIASES = frozenset(SOFT_ALIAS_MAP.keys() | SOFT_ALIAS_MAP.values())
+
+
+def _tokenize(line: str) -> list[str]:
+    line = line.strip() + " "
+    for old, new in _TOKEN_REPLACEMENTS:
+        line = line.replace(old, new)
+    if "/" in line:
+        for old, new in _SLASH_REPLACEMENTS:
+            line = line.replace(old, new)
+    return line.split()
+
+
+@functools.lru_cache(maxsize=2048)
+def _tokenize_cached(line: str) -> tuple[str, ...]:
+    return tuple(_tokenize(line))
+
+
+def _parse_name(
+    tokens: Sequence[T_TOKEN],
+    soft_label: bool,
+) -> tuple[str, T_POINT_OPTS]:
+    if soft_label:
+        alias_map, aliases = SOFT_ALIAS_MAP, SOFT_ALIASES
+    else:
+        alias_map, aliases = ALIAS_MAP, ALIASES
+    if not tokens:
+        raise SyntaxError("Can't parse point name")
+    name, *rest = tokens
+    assert isinstance(name, str)
+
+    if rest and rest[-1] in aliases:
+        *rest, opts = rest
+        assert isinstance(opts, str)
+    else:
+        opts = ""
+    opts = alias_map.get(opts, opts)
+    direction = None
+
+    if rest:
+        dirs, *rest = rest
+        assert isinstance(dirs, str)
+        if m := _RADIUS_DIR_RE.fullmatch(dirs):
+            direction = f"{m.groups()[0]}*dir({m.groups()[1]})"
+        elif dir_pairs := _DIR_PAIR_RE.findall(dirs):
+            direction = "+".join([f"{n}*plain.{w}" for n, w in dir_pairs])
+        elif dirs.isdigit():
+            direction = f"dir({dirs})"
+        elif _COMPASS_RE.fullmatch(dirs):
+            direction = f"plain.{dirs}"
+        else:
+            rest.append(dirs)
+    if direction is None:
+        direction = f"dir({name})"
+
+    if rest:
+        raise SyntaxError("Can't parse point name")
+    return name, ("d" in opts, name if "l" in opts else None, direction)
+
+
+_parse_name_cached = functools.lru_cache(maxsize=4096)(_parse_name)
 
 
 class Parser:
-    def __init__(self, soft_label: str | None = None, **_: Any):
+    def __init__(
+        self,
+        soft_label: str | None = None,
+        cache: bool = False,
+        **_: Any,
+    ):
         self.soft_label = soft_label
-        self.alias_map = {"": "dl", ":": "", ".": "d", ";": "l"}
-        if self.soft_label:
-            self.alias_map |= {"": "l", ";": "dl"}
-        self.aliases = self.alias_map.keys() | self.alias_map.values()
+        self.cache = cache
 
     def tokenize(self, line: str) -> list[T_TOKEN]:
-        line = line.strip() + " "
-        for old, new in [
-            # ~ and = are separate tokens
-            ("~", " ~ "),
-            ("=", " = "),
-            # for tsqx syntax processing
-            ("(", "( "),
-            (")", " ) "),
-            (",", " , "),
-            # spline joiners
-            ("--", " --  "),
-            ("..", " .. "),
-            ("^^", " ^^ "),
-            # no spaces around asymptote arithmetic
-            (" +", "+"),
-            ("+ ", "+"),
-            ("- ", "-"),
-            (" *", "*"),
-            ("* ", "*"),
-            # but slashes in draw ops should remain tokens
-            (" / ", "  /  "),
-            (" /", "/"),
-            ("/ ", "/"),
-            # ' not allowed in variable names
-            ("'", "_prime"),
-            ("&", "_asterisk"),
-        ]:
-            line = line.replace(old, new)
-        return list(filter(None, line.split()))
-
-    def parse_subexp(
-        self,
-        tokens: list[T_TOKEN],
-        idx: int,
-        func_mode=False,
-    ) -> tuple[T_TOKEN, int]:
-        token = tokens[idx]
-        if token[-1] == "(":
-            is_func = len(token) > 1
-            res: list[T_TOKEN] = []
-            idx += 1
-            if is_func:
-                res.append(token[:-1])
-            while tokens[idx] != ")":
-                exp, idx = self.parse_subexp(tokens, idx, is_func)
-                res.append(exp)
-            return res, idx + 1
-        if token == "," and func_mode:
-            return "", idx + 1
-        return token, idx + 1
+        if self.cache:
+            return list(_tokenize_cached(line))
+        return _tokenize(line)
 
     def parse_exp(self, tokens: list[T_TOKEN]):
         if tokens[0][-1] != "(" or tokens[-1] != ")":
             tokens = ["(", *tokens, ")"]
         res: list[T_TOKEN] = []
-        idx = 0
-        while idx != len(tokens):
-            try:
-                exp, idx = self.parse_subexp(tokens, idx)
-                res.append(list(filter(None, exp)))
-            except IndexError:
-                raise SyntaxError(f"Unexpected end of line: {tokens}")
+        # open parentheses, and whether each one is a function call
+        stack: list[list[T_TOKEN]] = []
+        func_stack: list[bool] = []
+        for token in tokens:
+            if token[-1] == "(":
+                is_func = len(token) > 1
+                stack.append([token[:-1]] if is_func else [])
+                func_stack.append(is_func)
+            elif not stack:
+                res.append(list(token))
+            elif token == ")":
+                exp = stack.pop()
+                func_stack.pop()
+                if not exp:
+                    # empty () groups contribute nothing
+                    continue
+                if stack:
+                    stack[-1].append(exp)
+                else:
+                    res.append(exp)
+            # commas between function arguments are re-added on emit
+            elif token != "," or not func_stack[-1]:
+                stack[-1].append(token)
+        if stack:
+            raise SyntaxError(f"Unexpected end of line: {tokens}")
         return res
 
     def parse_special(
@@ -252,39 +356,10 @@ class Parser:
         else:
             raise SyntaxError("Special command not recognized")
 
-    def parse_name(self, tokens: list[T_TOKEN]) -> tuple[str, dict[str, Any]]:
-        if not tokens:
-            raise SyntaxError("Can't parse point name")
-        name, *rest = tokens
-        assert isinstance(name, str)
-
-        if rest and rest[-1] in self.aliases:
-            *rest, opts = rest
-            assert isinstance(opts, str)
-        else:
-            opts = ""
-        opts = self.alias_map.get(opts, opts)
-        options = {"dot": "d" in opts, "label": name if "l" in opts else None}
-
-        if rest:
-            dirs, *rest = rest
-            assert isinstance(dirs, str)
-            if m := re.fullmatch(r"([\d\.]+)R([\d\.]+)", dirs):
-                options["direction"] = f"{m.groups()[0]}*dir({m.groups()[1]})"
-            elif dir_pairs := re.findall(r"(\d+)([A-Z]+)", dirs):
-                options["direction"] = "+".join(f"{n}*plain.{w}" for n, w in dir_pairs)
-            elif dirs.isdigit():
-                options["direction"] = f"dir({dirs})"
-            elif re.fullmatch(r"N?S?E?W?", dirs):
-                options["direction"] = f"plain.{dirs}"
-            else:
-                rest.append(dirs)
-        if "direction" not in options:
-            options["direction"] = f"dir({name})"
-
-        if rest:
-            raise SyntaxError("Can't parse point name")
-        return name, options
+    def parse_name(self, tokens: list[T_TOKEN]) -> tuple[str, T_POINT_OPTS]:
+        if self.cache:
+            return _parse_name_cached(tuple(tokens), bool(self.soft_label))
+        return _parse_name(tokens, bool(self.soft_label))
 
     def parse_draw(self, tokens: list[T_TOKEN]):
         try:
@@ -304,13 +379,16 @@ class Parser:
         fill: list[str] = []
         for pen in fill_:
             assert isinstance(pen, str)
-            if re.fullmatch(r"\d*\.?\d*", pen):
+            if _is_opacity(pen):
                 fill.append(f"opacity({pen})")
             else:
                 fill.append(pen)
 
         return {"fill": "+".join(fill), "outline": "+".join(outline)}
 
+    def parse_line(self, line: str) -> list[T_OCR]:
+        return list(self.parse(line))
+
     def parse(self, line: str) -> Generator[T_OCR, None, None]:
         # escape sequence
         raw_line = line
@@ -326,36 +404,37 @@ class Parser:
             line, comment = line.split("#", 1)
         else:
             comment = ""
-        tokens = self.tokenize(line)
-        if not tokens:
+        if not line.strip():
             yield {"op": Blank(), "comment": comment, "raw": raw_line}
             return
+        tokens = self.tokenize(line)
         # special
         if tokens[0] == "~":
             yield from self.parse_special(tokens[1:], comment, raw_line)
             return
+        eq_idx = slash_idx = -1
+        for i, token in enumerate(tokens):
+            if token == "=":
+                eq_idx = i
+                break
+            if token == "/" and slash_idx < 0:
+                slash_idx = i
         # point
-        try:
-            idx = tokens.index("=")
-            name, options = self.parse_name(tokens[:idx])
-            exp = self.parse_exp(tokens[idx + 1 :])
+        if eq_idx >= 0:
+            name, options = self.parse_name(tokens[:eq_idx])
+            exp = self.parse_exp(tokens[eq_idx + 1 :])
             yield {
-                "op": Point(name, exp, **options),
+                "op": Point(name, exp, *options),
                 "comment": comment,
                 "raw": raw_line,
             }
             return
-        except ValueError:
-            pass
         # draw with options
-        try:
-            idx = tokens.index("/")
-            exp = self.parse_exp(tokens[:idx])
-            options = self.parse_draw(tokens[idx + 1 :])
+        if slash_idx >= 0:
+            exp = self.parse_exp(tokens[:slash_idx])
+            options = self.parse_draw(tokens[slash_idx + 1 :])
             yield {"op": Draw(exp, **options), "comment": comment, "raw": raw_line}
             return
-        except ValueError:
-            pass
         # draw without options
         exp = self.parse_exp(tokens)
         yield {"op": Draw(exp), "comment": comment, "raw": raw_line}
@@ -375,41 +454,60 @@ class Emitter:
         self.size = args.get("size", "8cm")
         self.parser = Parser(**args)
         self.terse = args.get("terse", False)
+        self.jobs = args.get("jobs", 1)
 
-    def emit(self):
-        if self.preamble:
-            self.print(GENERIC_PREAMBLE % self.size)
-
-        ocrs = [ocr for line in self.lines for ocr in self.parser.parse(line)]
+    def parse_lines(self) -> Generator[T_OCR, None, None]:
+        if self.jobs > 1:
+            from multiprocessing import Pool
 
-        for ocr in ocrs:
-            self.print(
-                ocr["op"].emit() + (f" //{c}" if (c := ocr["comment"].rstrip()) else "")
-            )
-        self.print()
+            with Pool(self.jobs) as pool:
+                for ocrs in pool.imap(self.parser.parse_line, self.lines, 256):
+                    yield from ocrs
+        else:
+            for line in self.lines:
+                yield from self.parser.parse(line)
 
-        for ocr in ocrs:
-            if out := ocr["op"].post_emit():
-                self.print(out)
+    def emit(self):
+        buf = StringIO()
+        if self.preamble:
+            buf.write(GENERIC_PREAMBLE % self.size)
+            buf.write("\n")
+
+        # post-emit output and the raw source are only known once every
+        # line has been read, so only those are held back
+        post_buf = StringIO()
+        raw_buf = StringIO()
+        for ocr in self.parse_lines():
+            op = ocr["op"]
+            buf.write(op.emit())
+            if c := ocr["comment"].rstrip():
+                buf.write(f" //{c}")
+            buf.write("\n")
+            if out := op.post_emit():
+                post_buf.write(out)
+                post_buf.write("\n")
+            if not self.terse and (x := ocr["raw"].strip()):
+                raw_buf.write(x)
+                raw_buf.write("\n")
+        buf.write("\n")
+        buf.write(post_buf.getvalue())
 
         if not self.terse:
-            self.print("")
-            self.print(
+            buf.write("\n")
+            buf.write(
                 r"/* -----------------------------------------------------------------+"
-            )
-            self.print(
+                "\n"
                 r"|                 TSQX: by CJ Quines and Evan Chen                  |"
-            )
-            self.print(
+                "\n"
                 r"| https://github.com/vEnhance/dotfiles/blob/main/py-scripts/tsqx.py |"
-            )
-            self.print(
+                "\n"
                 r"+-------------------------------------------------------------------+"
+                "\n"
             )
-            for ocr in ocrs:
-                if x := ocr["raw"].strip():
-                    self.print(x)
-            self.print("*/")
+            buf.write(raw_buf.getvalue())
+            buf.write("*/\n")
+
+        self.print(buf.getvalue(), end="")
 
 
 def main():
@@ -447,6 +545,14 @@ def main():
         dest="soft_label",
         default=False,
     )
+    argparser.add_argument(
+        "-c",
+        "--cache",
+        help="Memoize parsing, for inputs with many repeated lines.",
+        action="store_true",
+        dest="cache",
+        default=False,
+    )
     argparser.add_argument(
         "-t",
         "--terse",
@@ -455,6 +561,15 @@ def main():
         dest="terse",
         default=False,
     )
+    argparser.add_argument(
+        "-j",
+        "--jobs",
+        help="Parse lines in this many processes, for large inputs.",
+        action="store",
+        type=int,
+        dest="jobs",
+        default=1,
+    )
 
     args = argparser.parse_args()
     stream = open(args.fname, "r") if args.fname else sys.stdin